@@ -14,31 +14,72 @@ Options:
     --method       Transparency method: auto | chromakey | sam3 (default: auto)
     --subject      SAM3 segmentation prompt (only for --method sam3)
     --duration     Video duration: 5 | 10 seconds (default: 5)
+    --oversize     Background render scale before center-crop, >= 1.0 (default: 1.15)
+    --skip-mask-validation  Don't decode an RGBA --mask to check its alpha range
     --format       Output format: webm | mp4 | both (default: webm)
+    --encode-preset  Encoder speed: realtime | fast | quality (default: realtime)
+    --no-cache     Re-generate even if the same image/prompt/settings were generated before
     --output       Output file path (default: <input_name>-animated.<ext>)
 
 Requires:
     - REPLICATE_API_TOKEN environment variable
     - FFmpeg installed on PATH
+
+Environment:
+    CHAR_ANIM_FFMPEG_JOBS  Concurrent FFmpeg encodes when batching (default: 1);
+                           VP9 threads are split evenly between them
 """
 import argparse
-import math
+import collections
+import colorsys
+import functools
+import hashlib
+import importlib
+import importlib.util
+import io
 import os
+import re
 import shutil
 import subprocess
 import sys
 import tempfile
-
-try:
-    import replicate
-    import requests
-    from PIL import Image
-except ImportError:
-    print("Installing required packages...")
-    subprocess.check_call([sys.executable, "-m", "pip", "install", "replicate", "requests", "Pillow", "-q"])
-    import replicate
-    import requests
-    from PIL import Image
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Third-party modules are imported by ensure_deps() once arguments are
+# validated, so --help and early errors don't pay for replicate/pydantic
+np = replicate = requests = Image = None
+
+REQUIRED_PACKAGES = {'numpy': 'numpy', 'replicate': 'replicate', 'requests': 'requests', 'PIL': 'Pillow'}
+
+
+def ensure_deps():
+    """Import the third-party modules, pip-installing any that are missing."""
+    global np, replicate, requests, Image
+    if Image is not None:
+        return
+    missing = [pkg for mod, pkg in REQUIRED_PACKAGES.items() if importlib.util.find_spec(mod) is None]
+    if missing:
+        print("Installing required packages...")
+        subprocess.check_call([sys.executable, "-m", "pip", "install", *missing, "-q"])
+        importlib.invalidate_caches()
+    np = importlib.import_module('numpy')
+    replicate = importlib.import_module('replicate')
+    requests = importlib.import_module('requests')
+    Image = importlib.import_module('PIL.Image')
+
+
+@functools.lru_cache(maxsize=None)
+def http_session():
+    """One pooled session for all downloads: Replicate delivery URLs share a host,
+    so keep-alive saves a TCP+TLS handshake per file."""
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=8,
+                                          max_retries=Retry(total=3, backoff_factor=0.3)))
+    return session
 
 
 def get_url(output):
@@ -50,91 +91,330 @@ def get_url(output):
 
 
 def download(url, dest):
-    resp = requests.get(url, stream=True)
-    resp.raise_for_status()
-    with open(dest, 'wb') as f:
-        for chunk in resp.iter_content(chunk_size=8192):
-            f.write(chunk)
+    # Stream into a uniquely named side file and rename, so an interrupted
+    # transfer never leaves a truncated file under the final name, and
+    # concurrent downloads of the same cache entry never share a file
+    fd, part = tempfile.mkstemp(dir=os.path.dirname(dest) or '.', suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f, http_session().get(url, stream=True, timeout=(5, 60)) as resp:
+            resp.raise_for_status()
+            resp.raw.decode_content = True
+            shutil.copyfileobj(resp.raw, f, length=1024 * 1024)
+        os.replace(part, dest)
+    except BaseException:
+        os.remove(part)
+        raise
 
 
 def log(step, msg):
     print(f"  [{step}] {msg}")
 
 
-def find_key_color(image_path):
-    """Scan an RGBA image and find the color most distant from any opaque pixel.
-    Returns (r, g, b) tuple and the hex string for FFmpeg chromakey."""
-    img = Image.open(image_path).convert('RGBA')
-    pixels = img.getdata()
-    opaque = [(r, g, b) for r, g, b, a in pixels if a > 128]
-    img.close()
+def even(x):
+    """Round up to the next even number."""
+    return (x + 1) & ~1
+
+
+@functools.lru_cache(maxsize=None)
+def ffmpeg_encoders():
+    """Return the set of encoder names compiled into the FFmpeg on PATH."""
+    result = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'], capture_output=True, text=True)
+    names = set()
+    for line in result.stdout.splitlines():
+        parts = line.split()
+        if len(parts) >= 2 and parts[0][0] in 'VAS' and len(parts[0]) == 6:
+            names.add(parts[1])
+    return names
+
+
+# Every video input is a known-format file (Replicate's MP4s or our own WebM), so
+# cap stream analysis at 512 KB / 0.5 s instead of FFmpeg's default 5 MB / 5 s.
+# (-analyzeduration 0 would mean "use the default", hence the explicit value.)
+# Per-input options: must precede each '-i'.
+PROBE_ARGS = ['-probesize', '512k', '-analyzeduration', '500000', '-fflags', '+genpts']
+
+# Decode Replicate's H.264 inputs on whatever hardware decoder FFmpeg finds
+# (VAAPI/NVDEC/VideoToolbox), leaving the CPU to libvpx; frames are copied back
+# to system memory automatically, and FFmpeg falls back to software decode.
+# Not used on our own VP9 WebM, whose alpha plane only the software decoder keeps.
+HWACCEL_ARGS = ['-hwaccel', 'auto']
+
+# FFmpeg's HTTP client neither retries nor times out by default. For inputs read
+# straight from a Replicate delivery URL, reconnect on dropped connections and
+# give up on a stalled read after 60 s, matching download()'s retries/timeout.
+URL_INPUT_ARGS = ['-reconnect', '1', '-reconnect_streamed', '1',
+                  '-reconnect_on_network_error', '1', '-rw_timeout', '60000000']
+
+
+def input_args(src):
+    """Per-input options for src: URL_INPUT_ARGS for URLs, then PROBE_ARGS."""
+    if src.startswith(('http://', 'https://')):
+        return [*URL_INPUT_ARGS, *PROBE_ARGS]
+    return PROBE_ARGS
+
+VAAPI_DEVICE = '/dev/dri/renderD128'
+NVIDIA_DEVICE = '/dev/nvidiactl'
+
+
+def hw_vp9_encode_cmd(src, vf, dest):
+    """Build an opaque VP9 encode on Intel QSV or VAAPI if the local FFmpeg and
+    hardware support one. Returns None when no hardware encoder is available.
+    These encoders have no alpha support, so this is only used for background
+    (yuv420p) output."""
+    encoders = ffmpeg_encoders()
+    # Static FFmpeg builds list QSV even on hosts without an Intel GPU; like
+    # VAAPI, it needs the DRM render node to be present
+    if 'vp9_qsv' in encoders and os.path.exists(VAAPI_DEVICE):
+        return [
+            'ffmpeg', '-y', '-init_hw_device', 'qsv=hw', '-filter_hw_device', 'hw',
+            *input_args(src), '-i', src,
+            '-vf', f'{vf},format=nv12,hwupload=extra_hw_frames=64',
+            '-c:v', 'vp9_qsv', '-preset', 'veryfast', '-b:v', '600k', '-an',
+            dest,
+        ]
+    if 'vp9_vaapi' in encoders and os.path.exists(VAAPI_DEVICE):
+        return [
+            'ffmpeg', '-y', '-vaapi_device', VAAPI_DEVICE,
+            *input_args(src), '-i', src,
+            '-vf', f'{vf},format=nv12,hwupload',
+            '-c:v', 'vp9_vaapi', '-b:v', '600k', '-an',
+            dest,
+        ]
+    return None
+
+
+def hw_h264_encode_cmd(src, graph, dest):
+    """Build an H.264 MP4 encode on NVENC or VAAPI if the local FFmpeg has one.
+    graph is an optional filter_complex run in software before upload.
+    Returns None when no hardware encoder is available."""
+    encoders = ffmpeg_encoders()
+    # Static FFmpeg builds list NVENC on every host; only try it when the
+    # NVIDIA driver's control device exists
+    if 'h264_nvenc' in encoders and os.path.exists(NVIDIA_DEVICE):
+        filters = ['-filter_complex', graph] if graph else []
+        return [
+            'ffmpeg', '-y', *PROBE_ARGS, '-i', src, *filters,
+            '-c:v', 'h264_nvenc', '-preset', 'p5', '-rc', 'vbr', '-cq', '26', '-b:v', '0',
+            '-pix_fmt', 'yuv420p', '-movflags', '+faststart', '-an',
+            dest,
+        ]
+    if 'h264_vaapi' in encoders and os.path.exists(VAAPI_DEVICE):
+        upload = f'{graph},format=nv12,hwupload' if graph else 'format=nv12,hwupload'
+        return [
+            'ffmpeg', '-y', '-vaapi_device', VAAPI_DEVICE,
+            *PROBE_ARGS, '-i', src,
+            '-filter_complex', upload,
+            '-c:v', 'h264_vaapi', '-qp', '26', '-movflags', '+faststart', '-an',
+            dest,
+        ]
+    return None
+
+
+def named_bytes_io(data, name):
+    """Wrap bytes in a file-like object with a filename, as Replicate file inputs expect."""
+    buf = io.BytesIO(data)
+    buf.name = name
+    return buf
+
+
+def upload_file(data, name):
+    """Upload bytes to Replicate's file API and return the hosted URL.
+    Returns None if the client has no file API or the upload fails."""
+    files = getattr(replicate, 'files', None)
+    if files is None:
+        return None
+    try:
+        uploaded = files.create(named_bytes_io(data, name))
+        return uploaded.urls['get']
+    except Exception as e:
+        log("upload", f"WARNING: File upload failed ({e}), sending inline")
+        return None
+
+
+def generate_video(model, image_path, prompt, duration, cfg_scale, loop):
+    """Animate image_path with Kling or MiniMax on Replicate.
+    Returns the URL of the generated MP4."""
+    # Read the image once; start_image and end_image get independent buffers
+    with open(image_path, 'rb') as f:
+        image_bytes = f.read()
+    image_name = os.path.basename(image_path)
+
+    if model == 'kling':
+        model_id = 'kwaivgi/kling-v2.1'
+        params = {
+            'prompt': prompt,
+            'start_image': named_bytes_io(image_bytes, image_name),
+            'duration': int(duration),
+            'mode': 'standard',
+            'negative_prompt': 'blurry, distorted, low quality, watermark',
+            'cfg_scale': cfg_scale,
+            'aspect_ratio': '16:9',
+        }
+        if loop:
+            # Upload once and pass the same hosted URL for both frames, so the
+            # client does not send the PNG twice
+            image_url = upload_file(image_bytes, image_name)
+            if image_url:
+                params['start_image'] = image_url
+                params['end_image'] = image_url
+            else:
+                params['end_image'] = named_bytes_io(image_bytes, image_name)
+            params['mode'] = 'pro'
+            log("loop", "Using start_image == end_image for seamless loop (mode=pro)")
+    elif model == 'minimax':
+        model_id = 'minimax/video-01'
+        params = {
+            'prompt': prompt,
+            'first_frame_image': named_bytes_io(image_bytes, image_name),
+            'prompt_optimizer': True,
+        }
+    else:
+        print(f"ERROR: Unknown model: {model}")
+        sys.exit(1)
+
+    output = replicate.run(model_id, input=params)
+    return get_url(output)
 
-    if not opaque:
-        return (0, 255, 255), '0x00FFFF'  # fallback cyan
 
-    # Test candidate key colors and pick the one furthest from any pixel
-    candidates = [
+def segment_sam3(video, prompt):
+    """Run SAM3 video segmentation on a video URL or local file path.
+    Returns the URL of the black-and-white mask video."""
+    handle = open(video, 'rb') if os.path.isfile(video) else None
+    try:
+        sam_out = replicate.run(
+            'lucataco/sam3-video:8cbab4c2a3133e679b5b863b80527f6b5c751ec7b33681b7e0b7c79c749df961',
+            input={
+                'video': handle or video,
+                'prompt': prompt,
+                'mask_only': True,
+            }
+        )
+    finally:
+        if handle:
+            handle.close()
+    return get_url(sam_out)
+
+
+# Per-user (not shared /tmp), created owner-only, so no other local user can
+# plant or swap a cached generation
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'char-anim')
+CACHE_MAX_ENTRIES = 20
+
+
+def cache_key(image_path, prompt, model, duration, loop, cfg_scale):
+    """Hash the generation inputs (image bytes + parameters) into a cache key."""
+    h = hashlib.sha256()
+    with open(image_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(block)
+    h.update(repr((prompt, model, int(duration), bool(loop), cfg_scale)).encode())
+    return h.hexdigest()
+
+
+def prune_cache(max_entries=CACHE_MAX_ENTRIES, part_max_age=3600):
+    """Delete the least recently used cached generations beyond max_entries,
+    plus .part files left by downloads killed more than part_max_age seconds ago."""
+    stale = time.time() - part_max_age
+    for entry in os.scandir(CACHE_DIR):
+        if entry.name.endswith('.part'):
+            try:
+                if entry.stat().st_mtime < stale:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+    entries = [e for e in os.scandir(CACHE_DIR) if e.name.endswith('.mp4')]
+    entries.sort(key=lambda e: e.stat().st_mtime, reverse=True)
+    for entry in entries[max_entries:]:
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
+
+
+@functools.lru_cache(maxsize=None)
+def key_color_candidates():
+    """Candidate chroma-key colors as a C x 3 int32 array."""
+    # The classic picks come first so they win ties; the rest sample the fully
+    # saturated hue arc cyan -> blue -> magenta -> red every 15 degrees. Green and
+    # yellow stay excluded. Saturated colors keep the key far from the neutral
+    # chroma that FFmpeg's chromakey (which compares U/V only) would confuse
+    # with grays.
+    colors = [
         (0, 255, 255),    # cyan
         (255, 0, 255),    # magenta
         (0, 0, 255),      # blue
         (255, 0, 0),      # red
         (255, 20, 147),   # hot pink
     ]
+    for hue in range(180, 360, 15):
+        rgb = tuple(round(c * 255) for c in colorsys.hsv_to_rgb(hue / 360, 1, 1))
+        if rgb not in colors:
+            colors.append(rgb)
+    return np.array(colors, dtype=np.int32)
+
+
+def load_rgba(image_path):
+    """Decode an image once into an H x W x 4 uint8 RGBA array."""
+    with Image.open(image_path) as img:
+        rgba = img if img.mode == 'RGBA' else img.convert('RGBA')
+        # Wrap the raw bytes directly (one copy, read-only view); an RGBA source
+        # also skips the convert() copy
+        return np.frombuffer(rgba.tobytes(), dtype=np.uint8).reshape(rgba.height, rgba.width, 4)
 
-    best_color = None
-    best_dist = -1
 
-    for cr, cg, cb in candidates:
-        min_dist = float('inf')
-        for r, g, b in opaque:
-            dist = math.sqrt((r - cr) ** 2 + (g - cg) ** 2 + (b - cb) ** 2)
-            if dist < min_dist:
-                min_dist = dist
-        if min_dist > best_dist:
-            best_dist = min_dist
-            best_color = (cr, cg, cb)
+def find_key_color(rgba):
+    """Scan an RGBA array and find the color most distant from any opaque pixel.
+    Returns (r, g, b) tuple and the hex string for FFmpeg chromakey."""
+    # Channel diffs fit in int16; squares are summed in int32
+    opaque = rgba[rgba[..., 3] > 128][:, :3].astype(np.int16)
+
+    if not len(opaque):
+        return (0, 255, 255), '0x00FFFF'  # fallback cyan
+
+    # For each candidate key color, the squared distance to the nearest pixel.
+    # One candidate at a time keeps every temporary N-sized, so memory stays
+    # flat however many candidates there are; no sqrt, ordering is the same.
+    candidates = key_color_candidates().astype(np.int16)
+    min_dist2 = [np.square(opaque - c, dtype=np.int32).sum(axis=1).min() for c in candidates]
+    # argmax returns the first maximum, so earlier candidates win ties
+    best_color = tuple(int(c) for c in candidates[int(np.argmax(min_dist2))])
 
     r, g, b = best_color
     hex_str = f'0x{r:02X}{g:02X}{b:02X}'
     return best_color, hex_str
 
 
-def detect_solid_background(image_path, tolerance=30, min_edge_ratio=0.65):
-    """Check if an RGB image has a solid-color background by sampling edge pixels.
+def detect_solid_background(arr, tolerance=30, min_edge_ratio=0.65):
+    """Check if an RGB array has a solid-color background by sampling edge pixels.
     Returns (key_color, hex_str) if a dominant edge color is found, or (None, None)."""
-    img = Image.open(image_path).convert('RGB')
-    w, h = img.size
-    pixels = img.load()
-
-    # Sample all pixels along the 4 edges
-    edge_pixels = []
-    for x in range(w):
-        edge_pixels.append(pixels[x, 0])           # top row
-        edge_pixels.append(pixels[x, h - 1])       # bottom row
-    for y in range(1, h - 1):
-        edge_pixels.append(pixels[0, y])            # left column
-        edge_pixels.append(pixels[w - 1, y])        # right column
-    img.close()
-
-    if not edge_pixels:
+
+    # Sample all pixels along the 4 edges, in the same order as a scan that
+    # alternates top/bottom rows, then left/right columns
+    edge_pixels = np.concatenate([
+        np.stack([arr[0], arr[-1]], axis=1).reshape(-1, 3),            # top + bottom rows
+        np.stack([arr[1:-1, 0], arr[1:-1, -1]], axis=1).reshape(-1, 3),  # left + right columns
+    ]).astype(np.int16)
+
+    if not len(edge_pixels):
         return None, None
 
-    # Find the most common edge color (within tolerance)
-    # Group similar colors together
-    from collections import Counter
-    color_counts = Counter(edge_pixels)
-    dominant_color, dominant_count = color_counts.most_common(1)[0]
+    # Find the most common edge color; ties go to the color seen first. Colors are
+    # packed into 24-bit keys so np.unique runs on one flat uint32 array
+    # instead of comparing rows.
+    rgb = edge_pixels.astype(np.uint32)
+    packed = (rgb[:, 0] << 16) | (rgb[:, 1] << 8) | rgb[:, 2]
+    _, first_seen, counts = np.unique(packed, return_index=True, return_counts=True)
+    top = np.flatnonzero(counts == counts.max())
+    dominant = edge_pixels[first_seen[top].min()]
 
     # Count how many edge pixels are within tolerance of the dominant color
-    dr, dg, db = dominant_color
-    close_count = 0
-    for r, g, b in edge_pixels:
-        dist = math.sqrt((r - dr) ** 2 + (g - dg) ** 2 + (b - db) ** 2)
-        if dist <= tolerance:
-            close_count += 1
-
-    ratio = close_count / len(edge_pixels)
+    # (channel diffs fit in int16; squares are summed in int32)
+    diff = edge_pixels - dominant
+    close = np.square(diff, dtype=np.int32).sum(axis=1) <= tolerance * tolerance
+
+    ratio = close.mean()
     if ratio >= min_edge_ratio:
+        dominant_color = tuple(int(c) for c in dominant)
         r, g, b = dominant_color
         hex_str = f'0x{r:02X}{g:02X}{b:02X}'
         return dominant_color, hex_str
@@ -142,16 +422,122 @@ def detect_solid_background(image_path, tolerance=30, min_edge_ratio=0.65):
     return None, None
 
 
-def bake_background(image_path, key_color, dest_path):
-    """Composite an RGBA image over a flat key-color background, save as RGB PNG."""
-    char_img = Image.open(image_path).convert('RGBA')
-    bg = Image.new('RGBA', char_img.size, (*key_color, 255))
-    bg.paste(char_img, (0, 0), char_img)
-    bg.convert('RGB').save(dest_path)
-    char_img.close()
-    bg.close()
+def has_transparency(rgba):
+    """Check if an RGBA array has an alpha channel that actually varies.
+    A flat alpha channel means no real transparency."""
+    alpha = rgba[..., 3]
+    return alpha.min() != alpha.max()
+
+
+def bake_background(rgba, key_color, dest_path):
+    """Composite an RGBA array over a flat key-color background, save as RGB PNG."""
+    # Integer blend in uint16 (255 * 255 fits), rounded half-up like the float form
+    a = rgba[..., 3:4].astype(np.uint16)
+    key = np.array(key_color, dtype=np.uint16)
+    out = (rgba[..., :3] * a + key * (255 - a) + 127) // 255
+    Image.fromarray(out.astype(np.uint8), 'RGB').save(dest_path)
 
 
+def ffmpeg_jobs():
+    """Read CHAR_ANIM_FFMPEG_JOBS, falling back to 1 on a missing or invalid value."""
+    value = os.environ.get('CHAR_ANIM_FFMPEG_JOBS', '1')
+    try:
+        return max(1, int(value))
+    except ValueError:
+        log("warn", f"Ignoring CHAR_ANIM_FFMPEG_JOBS={value!r} (not an integer), using 1")
+        return 1
+
+
+# Number of FFmpeg encodes allowed to run at once. Batch callers running animate()
+# from several threads are serialized on FFMPEG_SLOTS; separate processes should
+# set CHAR_ANIM_FFMPEG_JOBS to their count so each gets an equal share of cores.
+FFMPEG_JOBS = ffmpeg_jobs()
+FFMPEG_SLOTS = threading.BoundedSemaphore(FFMPEG_JOBS)
+
+# libvpx only spreads work across cores when the frame is split into tile columns;
+# row-mt on top lets each column be encoded by several threads
+VP9_THREAD_ARGS = ['-threads', str(max(1, (os.cpu_count() or 4) // FFMPEG_JOBS)),
+                   '-tile-columns', '2', '-frame-parallel', '0']
+
+# Encoder settings shared by every branch; the ENCODE_PRESETS speed args are
+# appended per call. Alpha needs yuva420p, no alt-ref frames and the WebM
+# alpha_mode flag (see references/technical.md).
+VP9_ALPHA_ARGS = ['-c:v', 'libvpx-vp9', *VP9_THREAD_ARGS, '-pix_fmt', 'yuva420p',
+                  '-auto-alt-ref', '0', '-b:v', '800k', '-crf', '35', '-row-mt', '1',
+                  '-metadata:s:v:0', 'alpha_mode=1', '-an']
+VP9_OPAQUE_ARGS = ['-c:v', 'libvpx-vp9', *VP9_THREAD_ARGS, '-pix_fmt', 'yuv420p',
+                   '-b:v', '600k', '-crf', '36', '-row-mt', '1', '-an']
+H264_ARGS = ['-c:v', 'libx264', '-preset', 'veryslow', '-crf', '26',
+             '-pix_fmt', 'yuv420p', '-movflags', '+faststart', '-an']
+
+# Filter graphs, filled in per call with str.format
+# setsar=1 on both legs: the still and the generated video rarely share a
+# sample aspect ratio, and the merged output should display at exactly w x h
+MASK_FILTER = ('[1:v]alphaextract,scale={w}:{h},setsar=1[amask];'
+               '[0:v]scale={w}:{h},setsar=1,format=yuva420p[vid];'
+               '[vid][amask]alphamerge=shortest=1[out]')
+CHROMAKEY_FILTER = 'scale={w}:{h},format=yuva420p,chromakey={key}:0.15:0.1'
+# tmix=frames=5 temporally smooths the SAM3 mask to eliminate flicker;
+# inflate x3 dilates it ~3px to recover edges SAM3 may have clipped
+SAM3_FILTER = ('[0:v]scale={w}:{h},format=yuva420p[vid];'
+               '[1:v]scale={w}:{h},format=gray,tmix=frames=5,inflate,inflate,inflate[mask];'
+               '[vid][mask]alphamerge[out]')
+# Top half = RGB, bottom half = alpha as grayscale (white=opaque, black=transparent)
+STACKED_ALPHA_FILTER = ('[0:v]split[rgb][a];'
+                        '[a]alphaextract[amask];'
+                        '[rgb]format=rgb24,pad=iw:ih*2[padded];'
+                        '[padded][amask]overlay=0:h')
+
+
+PROGRESS_LINE = re.compile(r'^(\w+)=(.*)$')
+
+
+def run_ffmpeg(cmd, timeout=600):
+    """Run an FFmpeg command while holding one of the FFMPEG_JOBS encode slots.
+    Shows live progress from -progress and returns a CompletedProcess whose stderr
+    holds the last 500 non-progress lines (errors only, at -loglevel error)."""
+    cmd = [cmd[0], '-hide_banner', '-nostats', '-loglevel', 'error', '-progress', 'pipe:2', *cmd[1:]]
+    tail = collections.deque(maxlen=500)
+    progress = {}
+    shown = False
+    with FFMPEG_SLOTS:
+        started = time.monotonic()
+        proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE, text=True, bufsize=1)
+        watchdog = threading.Timer(timeout, proc.kill)
+        watchdog.start()
+        try:
+            for line in proc.stderr:
+                match = PROGRESS_LINE.match(line.strip())
+                if not match:
+                    tail.append(line)
+                    continue
+                key, value = match.groups()
+                progress[key] = value
+                if key == 'progress':
+                    print(f"\r    frame={progress.get('frame', '?')} "
+                          f"time={progress.get('out_time', '?')[:11]} "
+                          f"speed={progress.get('speed', '?').strip()}", end='', flush=True)
+                    shown = True
+            proc.wait()
+        finally:
+            watchdog.cancel()
+    if shown:
+        print()
+    if proc.returncode < 0 and time.monotonic() - started >= timeout:
+        tail.append(f"FFmpeg killed after {timeout}s timeout\n")
+    return subprocess.CompletedProcess(cmd, proc.returncode, stderr=''.join(tail))
+
+
+# -deadline is libvpx's quality setting. In 'good' mode the encoder keeps its
+# default 25-frame lookahead (-lag-in-frames) for rate control even with
+# -auto-alt-ref 0, so alpha encodes lose only the alt-ref frames themselves.
+ENCODE_PRESETS = {
+    'realtime': ['-deadline', 'realtime', '-cpu-used', '8'],  # fastest; fine at mobile-ad bitrates
+    'fast': ['-deadline', 'good', '-cpu-used', '6'],
+    'quality': ['-deadline', 'good', '-cpu-used', '4'],       # slowest, best detail at the bitrate cap
+}
+
 MOTION_PRESETS = {
     'subtle': 0.3,     # logos, UI elements — very minimal animation
     'normal': 0.5,     # stationary characters — gentle movement
@@ -162,7 +548,8 @@ MOTION_PRESETS = {
 
 def animate(image_path, prompt, model='kling', asset_type='character', method='auto',
             subject=None, duration=5, output_path=None, loop=None, mask_path=None,
-            motion='auto', size=None, fmt='webm'):
+            motion='auto', size=None, fmt='webm', encode_preset='realtime', cache=True,
+            validate_mask=True, oversize=1.15):
     # Default: backgrounds always loop unless explicitly disabled
     if loop is None:
         loop = asset_type == 'background'
@@ -173,6 +560,10 @@ def animate(image_path, prompt, model='kling', asset_type='character', method='a
     cfg_scale = MOTION_PRESETS.get(motion, 0.5)
     log("motion", f"Motion: {motion} (cfg_scale={cfg_scale})")
 
+    vp9_speed = ENCODE_PRESETS[encode_preset]
+    # Hardware encoders trade some compression for speed; 'quality' stays on software
+    use_hw = encode_preset != 'quality'
+
     if not os.environ.get('REPLICATE_API_TOKEN'):
         print("ERROR: REPLICATE_API_TOKEN environment variable is required")
         sys.exit(1)
@@ -185,21 +576,18 @@ def animate(image_path, prompt, model='kling', asset_type='character', method='a
         print(f"ERROR: Image not found: {image_path}")
         sys.exit(1)
 
+    ensure_deps()
+
     if output_path is None:
         base = os.path.splitext(os.path.basename(image_path))[0]
         ext = '.mp4' if fmt == 'mp4' else '.webm'
         output_path = os.path.join(os.path.dirname(os.path.abspath(image_path)), f"{base}-animated{ext}")
 
     # Output dimensions: --size overrides, else source dims (capped)
-    # Render 15% oversized then center-crop to absorb AI-generated zoom drift
-    src = Image.open(image_path)
-    src_w, src_h = src.size
-    has_alpha = src.mode == 'RGBA'
-    if has_alpha:
-        alpha = src.getchannel('A')
-        alpha_range = alpha.getextrema()
-        has_alpha = alpha_range[0] != alpha_range[1]  # flat alpha = no real transparency
-    src.close()
+    # Render oversized (15% by default) then center-crop to absorb AI-generated zoom drift
+    # Image.open only parses the header -- no pixel data is decoded for the size probe
+    with Image.open(image_path) as src:
+        src_w, src_h = src.size
     if size:
         cap_w, cap_h = size
         log("size", f"Using explicit size: {cap_w}x{cap_h}")
@@ -207,15 +595,25 @@ def animate(image_path, prompt, model='kling', asset_type='character', method='a
         max_dim = 1080 if asset_type == 'background' else 720
         cap_w = min(src_w, max_dim)
         cap_h = min(src_h, max_dim)
-    oversized_w = int(cap_w * 1.15)
-    oversized_h = int(cap_h * 1.15)
     # Make dimensions even (required by VP9 and H.264)
-    oversized_w += oversized_w % 2
-    oversized_h += oversized_h % 2
-    crop_w = cap_w + (cap_w % 2)
-    crop_h = cap_h + (cap_h % 2)
-    scale = f'scale={oversized_w}:{oversized_h}:force_original_aspect_ratio=decrease,crop={crop_w}:{crop_h}'
-    log("size", f"Source: {src_w}x{src_h} -> Render: {oversized_w}x{oversized_h} -> Crop: {crop_w}x{crop_h}")
+    crop_w = even(cap_w)
+    crop_h = even(cap_h)
+    if oversize > 1.0:
+        oversized_w = even(int(cap_w * oversize))
+        oversized_h = even(int(cap_h * oversize))
+        scale = f'scale={oversized_w}:{oversized_h}:force_original_aspect_ratio=decrease,crop={crop_w}:{crop_h}'
+        log("size", f"Source: {src_w}x{src_h} -> Render: {oversized_w}x{oversized_h} -> Crop: {crop_w}x{crop_h}")
+    else:
+        # No drift margin: fit at output size and letterbox instead of cropping
+        scale = (f'scale={crop_w}:{crop_h}:force_original_aspect_ratio=decrease,'
+                 f'pad={crop_w}:{crop_h}:(ow-iw)/2:(oh-ih)/2')
+        log("size", f"Source: {src_w}x{src_h} -> Fit: {crop_w}x{crop_h} (no oversize)")
+
+    # Decode the source once for the pixel-analysis helpers (alpha check, solid
+    # background detection, key color, baking); mask/background/SAM3 runs skip it
+    src_rgba = None
+    if method == 'chromakey' or (method == 'auto' and not mask_path and asset_type != 'background'):
+        src_rgba = load_rgba(image_path)
 
     # Resolve auto method: chromakey if RGBA with alpha, solid-bg chromakey if detectable, else SAM3
     detected_bg = None
@@ -224,36 +622,42 @@ def animate(image_path, prompt, model='kling', asset_type='character', method='a
             method = 'mask'
         elif asset_type == 'background':
             method = 'background'
-        elif has_alpha:
+        elif has_transparency(src_rgba):
             method = 'chromakey'
         else:
             # No alpha -- check if image has a solid-color background we can chromakey directly
-            detected_bg, detected_hex = detect_solid_background(image_path)
+            detected_bg, detected_hex = detect_solid_background(src_rgba[..., :3])
             if detected_bg is not None:
                 method = 'chromakey'
                 log("method", f"Auto-selected: chromakey (detected solid background {detected_hex})")
             else:
                 method = 'sam3'
         if method != 'chromakey' or detected_bg is None:
-            log("method", f"Auto-selected: {method}" + (" (image has alpha)" if method == 'chromakey' and has_alpha else ""))
+            log("method", f"Auto-selected: {method}" + (" (image has alpha)" if method == 'chromakey' else ""))
 
     if mask_path and not os.path.exists(mask_path):
         print(f"ERROR: Mask image not found: {mask_path}")
         sys.exit(1)
 
-    # Ensure mask PNG is RGBA with proper alpha channel
+    # Ensure mask PNG is RGBA with proper alpha channel.
+    # Mode and size come from the PNG header; pixels are only decoded to convert
+    # a non-RGBA mask or to validate the alpha range.
     if mask_path:
         mask_img = Image.open(mask_path)
+        mask_w, mask_h = mask_img.size
         if mask_img.mode != 'RGBA':
             log("mask", f"Converting mask from {mask_img.mode} to RGBA...")
             mask_img = mask_img.convert('RGBA')
             mask_path_rgba = os.path.join(tempfile.mkdtemp(prefix="char-anim-mask-"), 'mask_rgba.png')
-            mask_img.save(mask_path_rgba)
+            # Only FFmpeg reads this copy, once: store it uncompressed
+            mask_img.save(mask_path_rgba, compress_level=0)
             mask_img.close()
             mask_path = mask_path_rgba
+        elif not validate_mask:
+            mask_img.close()
+            log("mask", "RGBA mask -- alpha validation skipped")
         else:
-            alpha = mask_img.getchannel('A')
-            extrema = alpha.getextrema()
+            extrema = mask_img.getextrema()[3]
             mask_img.close()
             if extrema[0] == extrema[1]:
                 log("warn", f"Mask alpha is flat ({extrema[0]}) -- no transparency variation. Output may lack cutout.")
@@ -265,8 +669,10 @@ def animate(image_path, prompt, model='kling', asset_type='character', method='a
         total = 2
     elif method == 'chromakey':
         total = 2  # generate (with baked bg) + chromakey encode
+    elif method == 'mask':
+        total = 2  # generate + mask/encode (single FFmpeg pass)
     else:
-        total = 3  # generate + SAM3/mask + encode
+        total = 3  # generate + SAM3 + encode
 
     # Add an extra step if we need both WebM and MP4
     need_mp4 = fmt in ('mp4', 'both')
@@ -274,6 +680,9 @@ def animate(image_path, prompt, model='kling', asset_type='character', method='a
         total += 1
 
     tmpdir = tempfile.mkdtemp(prefix="char-anim-")
+    if cache:
+        os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+    pool = ThreadPoolExecutor(max_workers=1)
 
     # Determine encoding targets and output paths
     if fmt == 'mp4':
@@ -302,10 +711,10 @@ def animate(image_path, prompt, model='kling', asset_type='character', method='a
                 log("key", f"Using detected background color: RGB{key_color} ({key_hex}) -- no baking needed")
             else:
                 # RGBA image -- find best key color and bake it
-                key_color, key_hex = find_key_color(image_path)
+                key_color, key_hex = find_key_color(src_rgba)
                 log("key", f"Best key color: RGB{key_color} ({key_hex}) -- most distant from all character pixels")
                 baked_path = os.path.join(tmpdir, 'baked_bg.png')
-                bake_background(image_path, key_color, baked_path)
+                bake_background(src_rgba, key_color, baked_path)
                 gen_image_path = baked_path
                 log("bake", f"Character composited onto {key_hex} background")
 
@@ -313,77 +722,72 @@ def animate(image_path, prompt, model='kling', asset_type='character', method='a
         current_step = 1
         print(f"\n[{current_step}/{total}] Generating animation with {model}...")
 
-        if model == 'kling':
-            model_id = 'kwaivgi/kling-v2.1'
-            params = {
-                'prompt': prompt,
-                'start_image': open(gen_image_path, 'rb'),
-                'duration': int(duration),
-                'mode': 'standard',
-                'negative_prompt': 'blurry, distorted, low quality, watermark',
-                'cfg_scale': cfg_scale,
-                'aspect_ratio': '16:9',
-            }
-            if loop:
-                params['end_image'] = open(gen_image_path, 'rb')
-                params['mode'] = 'pro'
-                log("loop", "Using start_image == end_image for seamless loop (mode=pro)")
-        elif model == 'minimax':
-            model_id = 'minimax/video-01'
-            params = {
-                'prompt': prompt,
-                'first_frame_image': open(gen_image_path, 'rb'),
-                'prompt_optimizer': True,
-            }
+        cache_path = None
+        if cache:
+            key = cache_key(gen_image_path, prompt, model, duration, loop, cfg_scale)
+            cache_path = os.path.join(CACHE_DIR, f'{key}.mp4')
+
+        if cache_path and os.path.exists(cache_path):
+            try:
+                os.utime(cache_path)  # mark as recently used
+            except OSError:
+                pass
+            log("cache", f"Reusing cached generation ({os.path.basename(cache_path)}) -- skipping {model}")
+            video_url = None
         else:
-            print(f"ERROR: Unknown model: {model}")
-            sys.exit(1)
-
-        output = replicate.run(model_id, input=params)
-        video_url = get_url(output)
-
-        generated = os.path.join(tmpdir, 'generated.mp4')
-        log("download", "Downloading generated video...")
-        download(video_url, generated)
+            video_url = generate_video(model, gen_image_path, prompt, duration, cfg_scale, loop)
+
+        sam_prompt = subject or 'character'
+        sam_future = None
+        if method == 'sam3':
+            # SAM3 reads the video straight from Replicate's delivery URL, so
+            # segmentation starts without waiting for any local copy
+            sam_future = pool.submit(segment_sam3, video_url or cache_path, sam_prompt)
+
+        if video_url is None:
+            generated = cache_path
+        elif cache_path:
+            # Fetch once into the cache and encode from that file, so the video
+            # is never downloaded twice (or three times on a hardware-encode
+            # retry). SAM3, already submitted above, overlaps this fetch.
+            try:
+                download(video_url, cache_path)
+                prune_cache()
+                generated = cache_path
+            except Exception as e:
+                log("warn", f"Could not cache generated video ({e}) -- streaming it instead")
+                generated = video_url
+        else:
+            # No cache: FFmpeg is the only local consumer and reads the delivery
+            # URL directly, so the fetch overlaps decode/encode instead of staging
+            # generated.mp4 on disk. (HTTP input stays seekable, unlike a stdin
+            # pipe, so MP4s with a trailing moov atom still demux; input_args
+            # adds reconnect/timeout.)
+            generated = video_url
         log("done", "Animation generated!")
 
+        # Software command to retry with if a hardware encode fails at runtime
+        # (encoder compiled in, but no usable device/driver)
+        fallback_cmd = None
+
         if method == 'mask':
             # ── MASK PATH: use original PNG alpha as mask ──
-            mask_img = Image.open(mask_path)
-            mask_w, mask_h = mask_img.size
-            mask_img.close()
             log("mask", f"Mask input: {mask_w}x{mask_h}, format confirmed RGBA")
-            out_w = mask_w + (mask_w % 2)
-            out_h = mask_h + (mask_h % 2)
+            out_w = even(mask_w)
+            out_h = even(mask_h)
 
+            # The still PNG is looped as a second input and its alpha extracted
+            # inside the same filter graph -- no intermediate mask video. The loop
+            # is unbounded; alphamerge=shortest=1 ends the graph with the video.
             current_step += 1
-            print(f"\n[{current_step}/{total}] Creating alpha mask video from {os.path.basename(mask_path)}...")
-            mask_video = os.path.join(tmpdir, 'mask.mp4')
-            mask_cmd = [
-                'ffmpeg', '-y', '-loop', '1', '-i', mask_path,
-                '-vf', f'alphaextract,scale={out_w}:{out_h}',
-                '-t', '10', '-r', '24',
-                '-c:v', 'libx264', '-pix_fmt', 'yuv420p',
-                mask_video,
-            ]
-            result = subprocess.run(mask_cmd, capture_output=True, text=True, timeout=120)
-            if result.returncode != 0:
-                print(f"ERROR: Mask creation failed:\n{result.stderr[-500:]}")
-                sys.exit(1)
-            log("done", f"Mask video created ({out_w}x{out_h})")
-
-            current_step += 1
-            print(f"\n[{current_step}/{total}] Masking video with PNG alpha -> transparent VP9...")
+            print(f"\n[{current_step}/{total}] Masking video with {os.path.basename(mask_path)} alpha -> transparent VP9...")
             ffmpeg_cmd = [
                 'ffmpeg', '-y',
-                '-i', generated,
-                '-i', mask_video,
-                '-filter_complex', f'[0:v]scale={out_w}:{out_h}[vid];[vid][1:v]alphamerge[out]',
+                *HWACCEL_ARGS, *input_args(generated), '-i', generated,
+                '-loop', '1', '-framerate', '24', '-i', mask_path,
+                '-filter_complex', MASK_FILTER.format(w=out_w, h=out_h),
                 '-map', '[out]',
-                '-c:v', 'libvpx-vp9', '-pix_fmt', 'yuva420p',
-                '-auto-alt-ref', '0', '-b:v', '800k', '-crf', '35',
-                '-speed', '4', '-row-mt', '1',
-                '-metadata:s:v:0', 'alpha_mode=1', '-an',
+                *VP9_ALPHA_ARGS, *vp9_speed,
                 '-shortest',
                 webm_target,
             ]
@@ -393,12 +797,15 @@ def animate(image_path, prompt, model='kling', asset_type='character', method='a
             current_step += 1
             print(f"\n[{current_step}/{total}] Encoding VP9 for mobile (<=720p)...")
             ffmpeg_cmd = [
-                'ffmpeg', '-y', '-i', generated,
+                'ffmpeg', '-y', *HWACCEL_ARGS, *input_args(generated), '-i', generated,
                 '-vf', scale,
-                '-c:v', 'libvpx-vp9', '-pix_fmt', 'yuv420p',
-                '-b:v', '600k', '-crf', '36', '-speed', '4', '-row-mt', '1', '-an',
+                *VP9_OPAQUE_ARGS, *vp9_speed,
                 webm_target,
             ]
+            hw_cmd = hw_vp9_encode_cmd(generated, scale, webm_target) if use_hw else None
+            if hw_cmd:
+                log("encode", f"Using hardware encoder {hw_cmd[hw_cmd.index('-c:v') + 1]}")
+                fallback_cmd, ffmpeg_cmd = ffmpeg_cmd, hw_cmd
 
         elif method == 'chromakey':
             # ── CHROMAKEY PATH: remove baked key color ──
@@ -406,54 +813,40 @@ def animate(image_path, prompt, model='kling', asset_type='character', method='a
             print(f"\n[{current_step}/{total}] Chromakey {key_hex} -> transparent VP9 ({crop_w}x{crop_h})...")
             ffmpeg_cmd = [
                 'ffmpeg', '-y',
-                '-i', generated,
-                '-vf', f'scale={crop_w}:{crop_h},chromakey={key_hex}:0.15:0.1,format=yuva420p',
-                '-c:v', 'libvpx-vp9', '-pix_fmt', 'yuva420p',
-                '-auto-alt-ref', '0', '-b:v', '800k', '-crf', '35',
-                '-speed', '4', '-row-mt', '1',
-                '-metadata:s:v:0', 'alpha_mode=1', '-an',
+                *HWACCEL_ARGS, *input_args(generated), '-i', generated,
+                '-vf', CHROMAKEY_FILTER.format(w=crop_w, h=crop_h, key=key_hex),
+                *VP9_ALPHA_ARGS, *vp9_speed,
                 webm_target,
             ]
 
         else:
             # ── SAM3 PATH: AI video segmentation (fallback for non-RGBA images) ──
-            sam_prompt = subject or 'character'
             current_step += 1
             print(f"\n[{current_step}/{total}] Segmenting subject with SAM3 (prompt: '{sam_prompt}')...")
-            sam_out = replicate.run(
-                'lucataco/sam3-video:8cbab4c2a3133e679b5b863b80527f6b5c751ec7b33681b7e0b7c79c749df961',
-                input={
-                    'video': open(generated, 'rb'),
-                    'prompt': sam_prompt,
-                    'mask_only': True,
-                }
-            )
-            mask_video_path = os.path.join(tmpdir, 'sam3_mask.mp4')
-            download(get_url(sam_out), mask_video_path)
+            # The mask video is streamed into the encode from its URL, like the
+            # generated video -- no sam3_mask.mp4 on disk
+            mask_video = sam_future.result()
             log("done", "SAM3 mask extracted!")
 
-            # Force both streams to exact same dimensions
-            # tmix=frames=5 temporally smooths the mask to eliminate flicker
-            # inflate x3 dilates the mask ~3px to recover edges SAM3 may have clipped
-            exact_scale = f'scale={crop_w}:{crop_h}'
+            # Force both streams to exact same dimensions; the color stream is
+            # converted to the output yuva420p layout once, before alphamerge
             current_step += 1
             print(f"\n[{current_step}/{total}] Alphamerge + VP9 encoding for mobile ({crop_w}x{crop_h})...")
             ffmpeg_cmd = [
                 'ffmpeg', '-y',
-                '-i', generated,
-                '-i', mask_video_path,
-                '-filter_complex',
-                f'[0:v]{exact_scale}[vid];[1:v]{exact_scale},format=gray,tmix=frames=5,inflate,inflate,inflate[mask];[vid][mask]alphamerge,format=yuva420p[out]',
+                *HWACCEL_ARGS, *input_args(generated), '-i', generated,
+                *HWACCEL_ARGS, *input_args(mask_video), '-i', mask_video,
+                '-filter_complex', SAM3_FILTER.format(w=crop_w, h=crop_h),
                 '-map', '[out]',
-                '-c:v', 'libvpx-vp9', '-pix_fmt', 'yuva420p',
-                '-auto-alt-ref', '0', '-b:v', '800k', '-crf', '35',
-                '-speed', '4', '-row-mt', '1',
-                '-metadata:s:v:0', 'alpha_mode=1', '-an',
+                *VP9_ALPHA_ARGS, *vp9_speed,
                 '-shortest',
                 webm_target,
             ]
 
-        result = subprocess.run(ffmpeg_cmd, capture_output=True, text=True, timeout=600)
+        result = run_ffmpeg(ffmpeg_cmd)
+        if result.returncode != 0 and fallback_cmd:
+            log("warn", "Hardware encode failed -- falling back to libvpx-vp9")
+            result = run_ffmpeg(fallback_cmd)
         if result.returncode != 0:
             print(f"ERROR: FFmpeg failed:\n{result.stderr[-500:]}")
             sys.exit(1)
@@ -474,30 +867,32 @@ def animate(image_path, prompt, model='kling', asset_type='character', method='a
             if method == 'background':
                 # Background: no alpha, just re-encode as H.264 for universal playback
                 print(f"\n[{current_step}/{total}] Encoding H.264 MP4 (opaque)...")
+                mp4_graph = None
                 mp4_cmd = [
-                    'ffmpeg', '-y', '-i', webm_target,
-                    '-c:v', 'libx264', '-preset', 'veryslow', '-crf', '26',
-                    '-pix_fmt', 'yuv420p', '-an',
+                    'ffmpeg', '-y', *PROBE_ARGS, '-i', webm_target,
+                    *H264_ARGS,
                     mp4_path,
                 ]
             else:
                 # Character/mask: stacked-alpha H.264 for iOS transparency
-                # Top half = RGB (character on key-color/scene background)
-                # Bottom half = alpha channel as grayscale (white=opaque, black=transparent)
                 print(f"\n[{current_step}/{total}] Encoding stacked-alpha H.264 MP4 (iOS-compatible)...")
+                mp4_graph = STACKED_ALPHA_FILTER
                 mp4_cmd = [
-                    'ffmpeg', '-y', '-i', webm_target,
-                    '-filter_complex',
-                    '[0:v]split[rgb][a];'
-                    '[a]alphaextract[amask];'
-                    '[rgb]format=rgb24,pad=iw:ih*2[padded];'
-                    '[padded][amask]overlay=0:h',
-                    '-c:v', 'libx264', '-preset', 'veryslow', '-crf', '26',
-                    '-pix_fmt', 'yuv420p', '-an',
+                    'ffmpeg', '-y', *PROBE_ARGS, '-i', webm_target,
+                    '-filter_complex', mp4_graph,
+                    *H264_ARGS,
                     mp4_path,
                 ]
 
-            result = subprocess.run(mp4_cmd, capture_output=True, text=True, timeout=600)
+            hw_cmd = hw_h264_encode_cmd(webm_target, mp4_graph, mp4_path) if use_hw else None
+            if hw_cmd:
+                log("encode", f"Using hardware encoder {hw_cmd[hw_cmd.index('-c:v') + 1]}")
+                result = run_ffmpeg(hw_cmd)
+                if result.returncode != 0:
+                    log("warn", "Hardware encode failed -- falling back to libx264")
+                    result = run_ffmpeg(mp4_cmd)
+            else:
+                result = run_ffmpeg(mp4_cmd)
             if result.returncode != 0:
                 print(f"ERROR: Stacked MP4 encoding failed:\n{result.stderr[-500:]}")
                 sys.exit(1)
@@ -536,6 +931,7 @@ def animate(image_path, prompt, model='kling', asset_type='character', method='a
         return output_path if fmt != 'mp4' else mp4_path
 
     finally:
+        pool.shutdown(wait=False, cancel_futures=True)
         shutil.rmtree(tmpdir, ignore_errors=True)
 
 
@@ -563,13 +959,26 @@ if __name__ == '__main__':
     parser.add_argument('--size', default=None,
                         help='Output size WxH (e.g. 960x960, 1080x1920). Overrides source dims. '
                              'Use for backgrounds that must match ad dimensions.')
+    parser.add_argument('--oversize', type=float, default=1.15,
+                        help='Background render scale before center-crop, absorbs AI zoom drift (default 1.15). '
+                             'Must be >= 1.0; 1.0 = fit and pad at output size, no crop')
     parser.add_argument('--mask', help='PNG with alpha channel to use as shape mask (skips AI bg removal)')
+    parser.add_argument('--skip-mask-validation', dest='validate_mask', action='store_false',
+                        help='Do not decode an RGBA --mask to check its alpha range (faster batch runs)')
     parser.add_argument('--format', dest='fmt', choices=['webm', 'mp4', 'both'], default='webm',
                         help='Output format: webm (VP9+alpha), mp4 (stacked-alpha H.264 for iOS), '
                              'both (outputs both files)')
+    parser.add_argument('--encode-preset', choices=list(ENCODE_PRESETS), default='realtime',
+                        help='Encoder speed: realtime (fastest), fast, or quality (slowest, previous default). '
+                             'realtime/fast also use hardware VP9/H.264 encoders when available')
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+                        help='Always call the video model, ignoring and not updating the local generation cache')
     parser.add_argument('--output', help='Output file path')
     args = parser.parse_args()
 
+    if args.oversize < 1.0:
+        parser.error(f"--oversize must be >= 1.0 (got {args.oversize})")
+
     # Parse --size WxH into (w, h) tuple
     parsed_size = None
     if args.size:
@@ -582,4 +991,4 @@ if __name__ == '__main__':
 
     animate(args.image, args.prompt, args.model, args.asset_type, args.method,
             args.subject, args.duration, args.output, args.loop, args.mask, args.motion,
-            parsed_size, args.fmt)
+            parsed_size, args.fmt, args.encode_preset, args.cache, args.validate_mask, args.oversize)